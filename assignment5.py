@@ -1,20 +1,280 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 import copy
 import itertools
+import multiprocessing
+import operator
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def supported_mask(supported, domain_j):
+    """Get the bitmask of all the values of i that have a support in the
+    bitmask 'domain_j', for the reverse support table 'supported' of an
+    arc (i, j). All the values of i are checked at once, with one OR per
+    value of j instead of one AND per value of i.
+    """
+    mask = 0
+    while domain_j:
+        value = domain_j & -domain_j
+        domain_j ^= value
+        mask |= supported[value.bit_length() - 1]
+    return mask
+
+# The CSP solved by a worker process of CSP.backtracking_search_parallel()
+worker_csp = None
+
+def init_worker(csp, stop_event):
+    """Initialize a worker process of CSP.backtracking_search_parallel()
+    with the CSP to solve, that is only sent once to every process, and
+    the event telling that a solution was found by another worker.
+    """
+    global worker_csp
+    worker_csp = csp
+    worker_csp.stop_event = stop_event
+
+def solve_subproblem(assignment):
+    """Run CSP.backtrack() in a worker process on the partial assignment
+    'assignment' of the worker's CSP. Returns the solution, or False,
+    with the number of calls and failures of the search.
+    """
+    csp = worker_csp
+    csp.number_calls = 0
+    csp.number_failures = 0
+    solution = csp.backtrack(assignment, [])
+
+    #The other workers can stop searching
+    if solution != False:
+        csp.stop_event.set()
+    return (solution, csp.number_calls, csp.number_failures)
+
+class AllDiffConstraint:
+    """An Alldiff constraint over a list of variables, filtered as a
+    whole with Regin's algorithm instead of being decomposed into binary
+    'different values' constraints. A value of a variable is kept only
+    if it belongs to a maximum matching between the variables and their
+    values, which also removes the values that can only be used by too
+    few variables (Hall sets) and that binary AC-3 never finds.
+    """
+    def __init__(self, variables, ids):
+        # self.variables is the list of the names of the variables, and
+        # self.ids the list of their indices in the CSP
+        self.variables = list(variables)
+        self.ids = list(ids)
+
+    def filter(self, assignment):
+        """Get the list of the new bitmasks of legal values of
+        self.variables, in the same order, or None if there is no way
+        to give different values to all of them in 'assignment'.
+        """
+        domains = [ assignment[x] for x in self.ids ]
+        n = len(domains)
+
+        #We first look for a matching that gives a different value to every variable
+        matched_value = [ -1 ] * n
+        matched_variable = {}
+        for x in range(n):
+            if not self.augment(x, domains, matched_value, matched_variable, set()):
+                return None
+
+        #In the value graph, the edges of the matching go from the variables to the values, and the other ones from the values to the variables.
+        #Vertex x < n is a variable, and vertex n + k is the value of bit index k
+        graph = { x: [ n + matched_value[x] ] for x in range(n) }
+        for x in range(n):
+            remaining = domains[x] ^ (1 << matched_value[x])
+            while remaining:
+                value = remaining & -remaining
+                remaining ^= value
+                graph.setdefault(n + value.bit_length() - 1, []).append(x)
+        for k in matched_variable:
+            graph.setdefault(n + k, [])
+
+        #An edge that is not in the matching is in another maximum matching if it is on an alternating path starting from a free value...
+        reachable = set(vertex for vertex in graph if vertex >= n and not vertex - n in matched_variable)
+        stack = list(reachable)
+        while len(stack) > 0:
+            for next_vertex in graph[stack.pop()]:
+                if not next_vertex in reachable:
+                    reachable.add(next_vertex)
+                    stack.append(next_vertex)
+
+        #... or on an alternating cycle, i.e. if both its ends are in the same strongly connected component
+        component = self.strongly_connected_components(graph)
+
+        new_domains = []
+        for x in range(n):
+            new_domain = 1 << matched_value[x]
+            remaining = domains[x] ^ new_domain
+            while remaining:
+                value = remaining & -remaining
+                remaining ^= value
+                vertex = n + value.bit_length() - 1
+                if vertex in reachable or component[vertex] == component[x]:
+                    new_domain |= value
+            new_domains.append(new_domain)
+        return new_domains
+
+    def augment(self, x, domains, matched_value, matched_variable, visited):
+        """Look for an augmenting path starting from the variable of
+        index 'x', and update the matching along it. Returns False if
+        there is none. As in backtrack(), the depth-first search keeps
+        an explicit stack instead of calling itself, so that long paths
+        don't hit the recursion limit: 'path' holds the variables of the
+        path with the values they have left to try, and 'path_values'
+        the values they are trying.
+        """
+        #Most of the time, a value of x is still free and there is no path to look for
+        remaining = domains[x]
+        while remaining:
+            value = remaining & -remaining
+            remaining ^= value
+            k = value.bit_length() - 1
+            if not k in matched_variable:
+                matched_value[x] = k
+                matched_variable[k] = x
+                return True
+
+        path = [ (x, domains[x]) ]
+        path_values = []
+        while len(path) > 0:
+            (y, remaining) = path[-1]
+
+            #No value of y leads to a free value, so we go back to the previous variable of the path
+            if not remaining:
+                path.pop()
+                if len(path_values) > 0:
+                    path_values.pop()
+                continue
+
+            value = remaining & -remaining
+            path[-1] = (y, remaining ^ value)
+            k = value.bit_length() - 1
+            if k in visited:
+                continue
+            visited.add(k)
+            path_values.append(k)
+
+            #The value is free, so every variable of the path takes the value it is trying
+            z = matched_variable.get(k)
+            if z is None:
+                for ((path_variable, path_remaining), path_value) in zip(path, path_values):
+                    matched_value[path_variable] = path_value
+                    matched_variable[path_value] = path_variable
+                return True
+
+            #Otherwise the variable using it has to take another one
+            path.append((z, domains[z]))
+
+        return False
+
+    def strongly_connected_components(self, graph):
+        """Tarjan's algorithm. Get a dictionary giving the number of the
+        strongly connected component of every vertex of 'graph'. The
+        depth-first search keeps the vertices being visited on the list
+        'visiting', with an iterator over the vertices they still have
+        to go to, instead of calling itself.
+        """
+        index = {}
+        lowlink = {}
+        component = {}
+        stack = []
+
+        for root in graph:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            visiting = [ (root, iter(graph[root])) ]
+
+            while len(visiting) > 0:
+                (vertex, next_vertices) = visiting[-1]
+                for next_vertex in next_vertices:
+                    if not next_vertex in index:
+                        #We go one step deeper, and come back to the other next vertices afterwards
+                        index[next_vertex] = lowlink[next_vertex] = len(index)
+                        stack.append(next_vertex)
+                        visiting.append((next_vertex, iter(graph[next_vertex])))
+                        break
+                    elif not next_vertex in component:
+                        lowlink[vertex] = min(lowlink[vertex], index[next_vertex])
+                else:
+                    #All the next vertices have been visited, so we go back to the previous vertex
+                    visiting.pop()
+                    if len(visiting) > 0:
+                        previous_vertex = visiting[-1][0]
+                        lowlink[previous_vertex] = min(lowlink[previous_vertex], lowlink[vertex])
+
+                    #The vertex is the root of a component, made of everything above it on the stack
+                    if lowlink[vertex] == index[vertex]:
+                        while True:
+                            other_vertex = stack.pop()
+                            component[other_vertex] = vertex
+                            if other_vertex == vertex:
+                                break
+
+        return component
 
 class CSP:
     def __init__(self):
-        # self.variables is a list of the variable names in the CSP
+        # self.variables is a list of the variable names in the CSP, and
+        # self.variable_ids[name] is the index of 'name' in this list.
+        # During the search, variables are only refered to by index
         self.variables = []
+        self.variable_ids = {}
 
         # self.domains[i] is a list of legal values for variable i
         self.domains = {}
 
-        # self.constraints[i][j] is a list of legal value pairs for
+        # self.constraints[i][j] is a frozenset of legal value pairs for
         # the variable pair (i, j)
         self.constraints = {}
 
+        # self.values is the list of all the values found in the domains.
+        # During the search, a domain is stored as an int bitmask where
+        # bit k is set when self.values[k] is still a legal value, and
+        # self.value_bits[value] gives the bit index k of 'value'
+        self.values = []
+        self.value_bits = {}
+
+        # self.arcs is the list of all the arcs (i, j) of the
+        # constraints, and self.neighboring_arcs[var] the list of the
+        # arcs (i, var) going to variable var. They are kept up to date
+        # by add_constraint_one_way(), so that the search never has to
+        # rebuild them
+        self.arcs = []
+        self.neighboring_arcs = {}
+
+        # The same arcs, as flat lists used by the search. An arc is
+        # refered to by its index in self.arcs, and self.arc_ids[(i, j)]
+        # gives the index of the arc (i, j). self.arc_heads[arc] and
+        # self.arc_tails[arc] are the indices of i and j.
+        # self.arc_support[arc][k] is the bitmask of the values of j
+        # that are compatible with the value of bit index k for i, and
+        # self.arc_supported[arc][l] the bitmask of the values of i that
+        # are compatible with the value of bit index l for j.
+        # self.arcs_from[x] and self.arcs_to[x] are the lists of the
+        # arcs going from and to the variable of index x.
+        # self.arc_kinds[arc] is 'neq' when the legal pairs of the arc
+        # are exactly the pairs of different values, which inference()
+        # revises without the support tables, and 'pairs' otherwise
+        self.arc_ids = {}
+        self.arc_heads = []
+        self.arc_tails = []
+        self.arc_support = []
+        self.arc_supported = []
+        self.arc_kinds = []
+        self.arcs_from = []
+        self.arcs_to = []
+
+        # self.alldiffs is the list of the AllDiffConstraint of the CSP,
+        # and self.alldiffs_of[x] the list of those involving the
+        # variable of index x
+        self.alldiffs = []
+        self.alldiffs_of = []
+
+        # self.stop_event is set by another process when the search can
+        # stop, see backtracking_search_parallel()
+        self.stop_event = None
+
         #Variables for stats
         self.number_calls = 0
         self.number_failures = 0
@@ -23,9 +283,49 @@ class CSP:
         """Add a new variable to the CSP. 'name' is the variable name
         and 'domain' is a list of the legal values for the variable.
         """
+        self.variable_ids[name] = len(self.variables)
         self.variables.append(name)
         self.domains[name] = list(domain)
         self.constraints[name] = {}
+        self.neighboring_arcs[name] = []
+        self.arcs_from.append([])
+        self.arcs_to.append([])
+        self.alldiffs_of.append([])
+
+        #We give a bit index to every value we have never seen before
+        for value in self.domains[name]:
+            if not value in self.value_bits:
+                self.value_bits[value] = len(self.values)
+                self.values.append(value)
+
+    def copy(self):
+        """Get a copy of the CSP whose domains can be reduced without
+        changing the domains of this CSP, for instance to solve several
+        problems sharing the same constraints. Only self.domains is
+        copied: the variables, the values and the constraints are shared
+        between both CSPs, so no variable or constraint can be added to
+        either of them anymore, and the new domains must only use values
+        that were already in the old ones.
+        """
+        other = copy.copy(self)
+        other.domains = dict(self.domains)
+        other.number_calls = 0
+        other.number_failures = 0
+        return other
+
+    def encode_domain(self, domain):
+        """Get the bitmask representing the list of values 'domain'.
+        """
+        bitmask = 0
+        for value in domain:
+            bitmask |= 1 << self.value_bits[value]
+        return bitmask
+
+    def decode_domain(self, bitmask):
+        """Get the list of values represented by the bitmask 'bitmask',
+        in the order in which the values were first added to the CSP.
+        """
+        return [ value for (k, value) in enumerate(self.values) if bitmask >> k & 1 ]
 
     def get_all_possible_pairs(self, a, b):
         """Get a list of all possible pairs (as tuples) of the values in
@@ -37,15 +337,17 @@ class CSP:
     def get_all_arcs(self):
         """Get a list of all arcs/constraints that have been defined in
         the CSP. The arcs/constraints are represented as tuples (i, j),
-        indicating a constraint between variable 'i' and 'j'.
+        indicating a constraint between variable 'i' and 'j'. The list
+        is shared by all the callers and must not be modified.
         """
-        return [ (i, j) for i in self.constraints for j in self.constraints[i] ]
+        return self.arcs
 
     def get_all_neighboring_arcs(self, var):
         """Get a list of all arcs/constraints going to/from variable
-        'var'. The arcs/constraints are represented as in get_all_arcs().
+        'var'. The arcs/constraints are represented as in
+        get_all_arcs(), and the list must not be modified either.
         """
-        return [ (i, var) for i in self.constraints[var] ]
+        return self.neighboring_arcs[var]
 
     def add_constraint_one_way(self, i, j, filter_function):
         """Add a new constraint between variables 'i' and 'j'. The legal
@@ -58,63 +360,256 @@ class CSP:
         """
         if not j in self.constraints[i]:
             # First, get a list of all possible pairs of values between variables i and j
-            self.constraints[i][j] = self.get_all_possible_pairs(self.domains[i], self.domains[j])
+            value_pairs = self.get_all_possible_pairs(self.domains[i], self.domains[j])
+        else:
+            value_pairs = self.constraints[i][j]
 
         # Next, filter this list of value pairs through the function
         # 'filter_function', so that only the legal value pairs remain
-        self.constraints[i][j] = filter(lambda value_pair: filter_function(*value_pair), self.constraints[i][j])
+        self.set_legal_pairs(i, j, frozenset((value_i, value_j) for (value_i, value_j) in value_pairs if filter_function(value_i, value_j)))
+
+    def add_not_equal_constraint_one_way(self, i, j):
+        """Add a new constraint between variables 'i' and 'j', one way
+        like add_constraint_one_way(), where the legal value pairs are
+        the pairs of different values. The pairs are built directly,
+        without going through a filter function.
+        """
+        if not j in self.constraints[i]:
+            value_pairs = frozenset((value_i, value_j) for value_i in self.domains[i] for value_j in self.domains[j] if value_i != value_j)
+            kind = 'neq'
+        else:
+            value_pairs = frozenset(value_pair for value_pair in self.constraints[i][j] if value_pair[0] != value_pair[1])
+            kind = self.arc_kinds[self.arc_ids[(i, j)]]
+
+        self.set_legal_pairs(i, j, value_pairs, kind)
+
+    def set_legal_pairs(self, i, j, value_pairs, kind='pairs'):
+        """Set the frozenset 'value_pairs' as the legal value pairs of
+        the constraint i -> j. The pairs are kept in a frozenset, so
+        that they can be read again and tested for membership in
+        constant time. 'kind' is the kind of the arc, see
+        self.arc_kinds.
+        """
+        if not j in self.constraints[i]:
+            # This is a new arc, so we add it to the cached lists
+            arc = len(self.arcs)
+            self.arcs.append((i, j))
+            self.neighboring_arcs[i].append((j, i))
+
+            self.arc_ids[(i, j)] = arc
+            self.arc_heads.append(self.variable_ids[i])
+            self.arc_tails.append(self.variable_ids[j])
+            self.arc_support.append(None)
+            self.arc_supported.append(None)
+            self.arc_kinds.append(None)
+            self.arcs_from[self.variable_ids[i]].append(arc)
+            self.arcs_to[self.variable_ids[j]].append(arc)
+
+        self.constraints[i][j] = value_pairs
+
+        #We translate the legal pairs into support tables in both directions, so that revising an arc only has to do bitwise operations
+        support = [0] * len(self.values)
+        supported = [0] * len(self.values)
+        for (value_i, value_j) in self.constraints[i][j]:
+            support[self.value_bits[value_i]] |= 1 << self.value_bits[value_j]
+            supported[self.value_bits[value_j]] |= 1 << self.value_bits[value_i]
+        arc = self.arc_ids[(i, j)]
+        self.arc_support[arc] = support
+        self.arc_supported[arc] = supported
+        self.arc_kinds[arc] = kind
 
     def add_all_different_constraint(self, variables):
         """Add an Alldiff constraint between all of the variables in the
         list 'variables'.
         """
-        for (i, j) in self.get_all_possible_pairs(variables, variables):
+        #Every pair of variables is visited once, and the constraint is added both ways
+        for (i, j) in itertools.combinations(variables, 2):
             if i != j:
-                self.add_constraint_one_way(i, j, lambda x, y: x != y)
+                self.add_not_equal_constraint_one_way(i, j)
+                self.add_not_equal_constraint_one_way(j, i)
+
+    def add_alldiff(self, variables):
+        """Add an Alldiff constraint between all of the variables in the
+        list 'variables', that is filtered as a whole during inference()
+        instead of being decomposed into binary constraints like
+        add_all_different_constraint() does. Both can be used on the
+        same variables, the binary constraints being cheaper to
+        propagate.
+        """
+        constraint = AllDiffConstraint(variables, [ self.variable_ids[var] for var in variables ])
+        self.alldiffs.append(constraint)
+        for x in constraint.ids:
+            self.alldiffs_of[x].append(constraint)
 
     def backtracking_search(self):
         """This functions starts the CSP solver and returns the found
         solution.
         """
-        # Make a so-called "deep copy" of the dictionary containing the
-        # domains of the CSP variables. The deep copy is required to
-        # ensure that any changes made to 'assignment' does not have any
-        # side effects elsewhere.
-        assignment = copy.deepcopy(self.domains)
+        assignment = self.initial_assignment()
+        if assignment == False:
+            return False
+
+        # Call backtrack with the partial assignment 'assignment' and an
+        # empty trail of modifications
+        solution = self.backtrack(assignment, [])
+        if solution == False:
+            return False
+
+        # Translate the bitmasks back into lists of values
+        return { var: self.decode_domain(solution[x]) for (x, var) in enumerate(self.variables) }
+
+    def backtracking_search_parallel(self, depth_limit=2, max_workers=None):
+        """Same as backtracking_search(), but the search is shared
+        between several processes. The first 'depth_limit' levels of the
+        search tree are expanded here, and every partial assignment
+        reached at that depth is solved by backtrack() in one of the
+        'max_workers' worker processes (by default, one per CPU). As
+        soon as one of them finds a solution, the other ones stop. The
+        stats add up the calls and failures of all the processes.
+        """
+        assignment = self.initial_assignment()
+        if assignment == False:
+            return False
+
+        #We expand the top of the search tree, which may already give a solution
+        subproblems = []
+        solution = self.split(assignment, depth_limit, subproblems)
+
+        if solution is None:
+            solution = False
+
+            #Every worker gets the CSP once, and the event to stop
+            stop_event = multiprocessing.Event()
+            with ProcessPoolExecutor(max_workers, initializer=init_worker, initargs=(self, stop_event)) as executor:
+                futures = [ executor.submit(solve_subproblem, subproblem) for subproblem in subproblems ]
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+
+                    (result, calls, failures) = future.result()
+                    self.number_calls += calls
+                    self.number_failures += failures
+
+                    #We keep the first solution, and the subproblems that didn't start yet are dropped
+                    if result != False and solution == False:
+                        solution = result
+                        stop_event.set()
+                        for other_future in futures:
+                            other_future.cancel()
+
+        if solution == False:
+            return False
+
+        # Translate the bitmasks back into lists of values
+        return { var: self.decode_domain(solution[x]) for (x, var) in enumerate(self.variables) }
+
+    def split(self, assignment, depth, subproblems):
+        """Expand the first 'depth' levels of the search tree from the
+        partial assignment 'assignment', as backtrack() would, and
+        append a copy of every partial assignment reached at that depth
+        to the list 'subproblems'. Returns the solution if one is found
+        before reaching that depth, None otherwise.
+        """
+        if depth == 0:
+            subproblems.append(list(assignment))
+            return None
+
+        self.number_calls+=1
+        Xi = self.select_unassigned_variable(assignment)
+        if Xi == None:
+            return assignment
+
+        trail = []
+        number_subproblems = len(subproblems)
+        remaining = assignment[Xi]
+        while remaining:
+            value = remaining & -remaining
+            remaining ^= value
+
+            trail.append((Xi, assignment[Xi], None))
+            assignment[Xi] = value
+            if self.propagate_decision(assignment, Xi, trail, 0):
+                solution = self.split(assignment, depth - 1, subproblems)
+                if solution is not None:
+                    return solution
+
+            self.undo(assignment, trail, 0)
+
+        #As in backtrack(), this is only a failure if none of the values is left for the workers to try
+        if len(subproblems) == number_subproblems:
+            self.number_failures+=1
+        return None
+
+    def initial_assignment(self):
+        """Get the partial assignment the search starts from, or False
+        if the CSP has no solution.
+        """
+        # Build the bitmask representation of the domains of the CSP
+        # variables. This is a new list, indexed like self.variables, so
+        # that any changes made to 'assignment' does not have any side
+        # effects elsewhere.
+        assignment = [ self.encode_domain(self.domains[var]) for var in self.variables ]
 
-        # Run AC-3 on all constraints in the CSP, to weed out all of the
-        # values that are not arc-consistent to begin with
-        self.inference(assignment, self.get_all_arcs())
+        # Run AC-3 on all constraints in the CSP, and filter all the
+        # Alldiff constraints, to weed out all of the values that are
+        # not arc-consistent to begin with
+        if not self.inference(assignment, range(len(self.arcs)), changed=range(len(self.variables))):
+            return False
 
-        # Call backtrack with the partial assignment 'assignment'
-        return self.backtrack(assignment)
+        return assignment
 
-    def backtrack(self, assignment):
+    def backtrack(self, assignment, trail):
         """The function 'Backtrack' from the pseudocode in the
         textbook.
 
-        The function is called recursively, with a partial assignment of
-        values 'assignment'. 'assignment' is a dictionary that contains
-        a list of all legal values for the variables that have *not* yet
-        been decided, and a list of only a single value for the
-        variables that *have* been decided.
+        The function starts from a partial assignment of values
+        'assignment'. 'assignment' is a list that contains, at the index
+        of every variable in self.variables, a bitmask of all legal
+        values for the variables that have *not* yet been decided, and
+        a bitmask of only a single value for the variables that *have*
+        been decided. All the functions used by the search refer to the
+        variables by these indices, and to the arcs by their indices in
+        self.arcs.
 
-        When all of the variables in 'assignment' have lists of length
-        one, i.e. when all variables have been assigned a value, the
+        When all of the variables in 'assignment' have a single bit set,
+        i.e. when all variables have been assigned a value, the
         function should return 'assignment'. Otherwise, the search
         should continue. When the function 'inference' is called to run
-        the AC-3 algorithm, the lists of legal values in 'assignment'
+        the AC-3 algorithm, the bitmasks of legal values in 'assignment'
         should get reduced as AC-3 discovers illegal values.
 
-        IMPORTANT: For every iteration of the for-loop in the
-        pseudocode, you need to make a deep copy of 'assignment' into a
-        new variable before changing it. Every iteration of the for-loop
+        Instead of calling itself recursively, the function keeps an
+        explicit stack with one tuple per level of the search tree: the
+        variable decided at that level, the values left to try, the
+        trail mark, the explanation of the variable's domain when the
+        level was entered, and the conflict set gathered from the
+        values that failed. Going one step deeper pushes a tuple, and a
+        level that fails is popped, which is the failure of a recursive
+        call.
+
+        IMPORTANT: Every iteration of the for-loop in the pseudocode
         should have a clean slate and not see any traces of the old
         assignments and inferences that took place in previous
-        iterations of the loop.
+        iterations of the loop. Instead of copying 'assignment', every
+        change made to it is recorded as a (variable, old bitmask, old
+        explanation) tuple on the list 'trail', and the changes made by
+        an iteration are undone from the trail before trying the next
+        value.
+
+        The search does conflict-directed backjumping instead of
+        chronological backtracking. explanations[x] is a bitmask of the
+        levels whose decisions caused values to be removed from the
+        domain of variable x. When a domain gets empty, the explanations
+        of the variables involved are the conflict set of the failure,
+        and the search jumps directly back to the deepest level of the
+        conflict set: the levels in between had nothing to do with the
+        failure, so trying their other values would fail the same way.
         """
-        
-        #Every time this functio is called, we have ont more backtracking step
+
+        #No value has been removed by a decision yet
+        explanations = [ 0 ] * len(assignment)
+
+        #Every time we go one step deeper, we have one more backtracking step
         self.number_calls+=1
 
         #We search a variable for which we can select a value
@@ -124,100 +619,304 @@ class CSP:
         if Xi == None:
             return assignment
 
-        #Either way, we try all the possible value fot this variable 
-        for value in assignment[Xi]:
+        #Either way, we will try all the possible values for this variable, i.e. all the bits of its bitmask.
+        #We also remember where the trail stands, so that we can undo everything done by an iteration
+        stack = [ (Xi, assignment[Xi], len(trail), explanations[Xi], 0) ]
 
-            #We create a deepcopy so that the next steps won't be affected by this one
-            current_assignment = copy.deepcopy(assignment)
+        while len(stack) > 0:
+            (Xi, remaining, mark, explanation, conflict) = stack[-1]
+            level = len(stack) - 1
 
-            #We select a value, i.e. we delete all the other possible values
-            current_assignment[Xi] = [value]
+            #Another process may have found a solution already
+            if self.stop_event is not None and self.stop_event.is_set():
+                return False
 
-            #We check if there is any modification due to an inference in the neighbors
-            if self.inference(current_assignment, self.get_all_neighboring_arcs(Xi)):
+            #The next steps won't be affected by the previous ones
+            self.undo(assignment, trail, mark, explanations)
 
-                #If that's the case, we backtrack
-                next_step = self.backtrack(current_assignment)
+            if remaining:
+                value = remaining & -remaining
+                stack[-1] = (Xi, remaining ^ value, mark, explanation, conflict)
 
-                #If the next step isn't a failure, it means we achieved to find a solution
-                if next_step != False:
-                    return next_step
+                #We select a value, i.e. we delete all the other possible values because of the decision of this level
+                trail.append((Xi, assignment[Xi], explanations[Xi]))
+                assignment[Xi] = value
+                explanations[Xi] |= 1 << level
 
-        #If we didn't find a solution after trying all the values, it means that we need to change something in the previous steps
-        self.number_failures+=1
+                #We check if there is any modification due to an inference
+                if self.propagate_decision(assignment, Xi, trail, mark, explanations):
+
+                    #If that's the case, we go one step deeper
+                    self.number_calls+=1
+                    Xi = self.select_unassigned_variable(assignment)
+
+                    #If all variable have a value, then the problem is solved
+                    if Xi == None:
+                        return assignment
+
+                    stack.append((Xi, assignment[Xi], len(trail), explanations[Xi], 0))
+                    continue
+
+                #The value failed, and the variable that has no value left is the last one on the trail
+                failure = explanations[trail[-1][0]]
+            else:
+                #If we didn't find a solution after trying all the values, it means that we need to change something in the previous steps.
+                #This is because of the failures of the values we tried, and of what removed the other values before this level
+                self.number_failures+=1
+                stack.pop()
+                failure = conflict | explanation
+
+            #We jump back over all the levels that aren't part of the failure
+            while len(stack) > 0 and not failure >> (len(stack) - 1) & 1:
+                self.number_failures+=1
+                stack.pop()
+
+            #The deepest level of the failure will try its next value, and remembers what else caused the failure
+            if len(stack) > 0:
+                (Xi, remaining, mark, explanation, conflict) = stack[-1]
+                stack[-1] = (Xi, remaining, mark, explanation, conflict | (failure & ~(1 << (len(stack) - 1))))
+
+        #All the values of the first variable failed, so there is no solution
         return False
 
+    def propagate_decision(self, assignment, x, trail, mark, explanations=None):
+        """Propagate the value just given to the variable of index 'x'
+        in 'assignment', whose old domain is recorded on 'trail' after
+        the mark 'mark'. Returns False if a variable has no possible
+        value left.
+        """
+        #We first remove the values of the neighbors that are incompatible with the decided variables
+        if not self.propagate_units(assignment, [x], trail, explanations):
+            return False
+
+        #Then we run AC-3 from the neighbors of every variable that changed
+        changed = set(entry[0] for entry in trail[mark:])
+        arcs = [ arc for y in changed for arc in self.arcs_to[y] ]
+        return self.inference(assignment, arcs, trail, explanations, changed)
+
+    def undo(self, assignment, trail, mark, explanations=None):
+        """Restore in 'assignment' the bitmasks recorded on 'trail',
+        until the trail has been shortened back to the length 'mark'.
+        The explanations are restored as well when 'explanations' is
+        given.
+        """
+        while len(trail) > mark:
+            (x, old_domain, old_explanation) = trail.pop()
+            assignment[x] = old_domain
+            if explanations is not None:
+                explanations[x] = old_explanation
+
     def select_unassigned_variable(self, assignment):
         """The function 'Select-Unassigned-Variable' from the pseudocode
-        in the textbook. Should return the name of one of the variables
-        in 'assignment' that have not yet been decided, i.e. whose list
-        of legal values has a length greater than one.
+        in the textbook. Should return the index of one of the variables
+        in 'assignment' that have not yet been decided, i.e. whose
+        bitmask of legal values has more than one bit set.
+
+        The Minimum-Remaining-Values heuristic is used: the undecided
+        variable with the fewest legal values is returned, and ties are
+        broken by taking the variable involved in the most constraints.
         """
-        
+        best = None
+        best_size = 0
+        best_degree = 0
+
         #We go through all the variables of the problem
-        for X in self.variables:
+        for X in range(len(assignment)):
+            domain = assignment[X]
 
-            #If the current variable has more than one possible value, it is not selected and we return it.
-            if len(assignment[X]) > 1:
-                return X
+            #If the current variable has only one possible value, it is already decided
+            if not domain & (domain - 1):
+                continue
 
-        #We didn't find any variable with more than one possible value. The game is solved. 
-        return None
+            #Otherwise we keep it if it has fewer possible values than the best one so far, or as many but more constraints
+            size = bin(domain).count('1')
+            degree = len(self.arcs_from[X])
+            if best is None or size < best_size or (size == best_size and degree > best_degree):
+                best = X
+                best_size = size
+                best_degree = degree
+
+        #If we didn't find any variable with more than one possible value, the game is solved and we return None
+        return best
+
+    def propagate_units(self, assignment, queue, trail=None, explanations=None):
+        """Forward checking of the decided variables. 'queue' is a list
+        of variables that have a single legal value left in
+        'assignment'. The values of their neighbors that are not
+        compatible with this single value are removed right away, and
+        every neighbor that gets decided that way is added to the queue
+        in turn. The reduced domains are recorded on 'trail' when it is
+        given, as in backtrack(), and the reduced variables inherit the
+        explanation of the decided variable when 'explanations' is
+        given. Returns False if a variable has no possible value left,
+        in which case this variable is the last one recorded on 'trail'.
+        """
+        arc_tails = self.arc_tails
+        arc_support = self.arc_support
+        queue = deque(queue)
+        while len(queue) > 0:
+            x = queue.popleft()
+            k = assignment[x].bit_length() - 1
+
+            for arc in self.arcs_from[x]:
+                neighbor = arc_tails[arc]
+                old_domain = assignment[neighbor]
+
+                #We only keep the values of the neighbor that are compatible with the value of x
+                new_domain = old_domain & arc_support[arc][k]
+                if new_domain == old_domain:
+                    continue
+
+                if trail is not None:
+                    trail.append((neighbor, old_domain, None if explanations is None else explanations[neighbor]))
+                if explanations is not None:
+                    explanations[neighbor] |= explanations[x]
+                assignment[neighbor] = new_domain
+
+                #If the neighbor has no possible value, we return a failure
+                if new_domain == 0:
+                    return False
+
+                #If the neighbor has only one value left, it is decided as well
+                if not new_domain & (new_domain - 1):
+                    queue.append(neighbor)
+
+        return True
 
-    def inference(self, assignment, queue):
+    def inference(self, assignment, queue, trail=None, explanations=None, changed=()):
         """The function 'AC-3' from the pseudocode in the textbook.
         'assignment' is the current partial assignment, that contains
-        the lists of legal values for each undecided variable. 'queue'
-        is the initial queue of arcs that should be visited.
+        the bitmasks of legal values for each undecided variable.
+        'queue' is the initial queue of indices of the arcs that should
+        be visited. When 'trail' is given, the domains reduced by the
+        inference are recorded on it, as in backtrack(). When
+        'explanations' is given, a variable reduced by the arc (i, j)
+        inherits the explanation of j. If a variable has no possible
+        value left, it is the last one recorded on 'trail'.
+
+        The Alldiff constraints involving the variables of 'changed', or
+        a variable reduced by the inference, are filtered every time the
+        queue of arcs gets empty, until nothing changes anymore. A
+        variable reduced by an Alldiff constraint inherits the
+        explanations of all the variables of the constraint.
         """
 
-        #We loop on the elements of the stack
-        while len(queue) > 0:
+        #We use a deque so that getting the first element doesn't shift the whole queue, and a flag per arc to know which arcs are already waiting
+        initial_queue = queue
+        queue = deque()
+        in_queue = bytearray(len(self.arcs))
+        for arc in initial_queue:
+            if not in_queue[arc]:
+                in_queue[arc] = 1
+                queue.append(arc)
 
-            #We get the first element
-            (Xi, Xj) = queue.pop(0)
+        #The Alldiff constraints we need to filter
+        dirty = set()
+        for x in changed:
+            dirty.update(self.alldiffs_of[x])
 
-            #If we changed something in the neighbors, we propagate these modifications
-            if self.revise(assignment, Xi, Xj):
+        while True:
+            #We loop on the elements of the queue
+            if not self.revise_queue(assignment, queue, in_queue, trail, explanations, dirty):
+                return False
 
-                #If the variable has no possible value, we return a failure
-                if len(assignment[Xi]) == 0:
+            #Once all the arcs are consistent, we filter the Alldiff constraints until one of them changes something
+            if len(dirty) == 0:
+                break
+            constraint = dirty.pop()
+            new_domains = constraint.filter(assignment)
+
+            #The constraint fails as a whole, and we give its first variable an empty domain to remember it on the trail
+            if new_domains is None:
+                new_domains = [ 0 ]
+
+            explanation = 0
+            if explanations is not None:
+                for x in constraint.ids:
+                    explanation |= explanations[x]
+
+            for (x, new_domain) in zip(constraint.ids, new_domains):
+                old_domain = assignment[x]
+                if new_domain == old_domain:
+                    continue
+
+                if trail is not None:
+                    trail.append((x, old_domain, None if explanations is None else explanations[x]))
+                if explanations is not None:
+                    explanations[x] = explanation
+                assignment[x] = new_domain
+                if new_domain == 0:
                     return False
 
-                #If it still has possible values, then we add all its neighbors to the queue
-                for arc in self.get_all_neighboring_arcs(Xi):
-                    queue.append(arc)
-        
+                #The neighbors of the reduced variable have to be revised again, and its other Alldiff constraints filtered again
+                for arc in self.arcs_to[x]:
+                    if not in_queue[arc]:
+                        in_queue[arc] = 1
+                        queue.append(arc)
+                dirty.update(self.alldiffs_of[x])
+                dirty.discard(constraint)
+
         #If we didn't encouter an empty variable, the inference was a success
         return True
 
-    def revise(self, assignment, i, j):
-        """The function 'Revise' from the pseudocode in the textbook.
-        'assignment' is the current partial assignment, that contains
-        the lists of legal values for each undecided variable. 'i' and
-        'j' specifies the arc that should be visited. If a value is
-        found in variable i's domain that doesn't satisfy the constraint
-        between i and j, the value should be deleted from i's list of
-        legal values in 'assignment'.
+    def revise_queue(self, assignment, queue, in_queue, trail, explanations, dirty):
+        """The main loop of inference(). Revises the arcs of the deque
+        'queue' until it is empty, keeping the flags 'in_queue' of the
+        arcs in it up to date, and adds to the set 'dirty' the Alldiff
+        constraints of the variables that get reduced. Returns False if
+        a variable has no possible value left.
         """
 
-        #We check all the possible values of i
-        for legal_i in assignment[i]:
-            #For the moment, we consider that we have to remove this 
-            revised = True
+        #This is the hot loop of the solver, so everything it needs is looked up only once and the function 'Revise' from the textbook is done inline
+        arc_heads = self.arc_heads
+        arc_tails = self.arc_tails
+        arc_supported = self.arc_supported
+        arc_kinds = self.arc_kinds
+        arcs_to = self.arcs_to
+        alldiffs_of = self.alldiffs_of
+        popleft = queue.popleft
+
+        #We loop on the elements of the queue
+        while queue:
 
-            #We do the same for the possible values of j 
-            for legal_j in assignment[j]:
+            #We get the first element
+            arc = popleft()
+            in_queue[arc] = 0
+            Xi = arc_heads[arc]
+            Xj = arc_tails[arc]
 
-                #If there is a constraint satisfying the tuple of these two values, we don't remove the value of i
-                if (legal_i, legal_j) in self.constraints[i][j]:
-                    revised = False
+            #If we changed something in the neighbors, we propagate these modifications
+            old_domain = assignment[Xi]
+            domain_j = assignment[Xj]
+            if arc_kinds[arc] == 'neq':
+                #A value of Xi always has a different value in Xj to support it, unless Xj is decided on this very value
+                if domain_j & (domain_j - 1):
+                    continue
+                new_domain = old_domain & ~domain_j
+            else:
+                #All the values of Xi without a support are removed at once
+                new_domain = old_domain & supported_mask(arc_supported[arc], domain_j)
+
+            if new_domain != old_domain:
+                if trail is not None:
+                    trail.append((Xi, old_domain, None if explanations is None else explanations[Xi]))
+                if explanations is not None:
+                    explanations[Xi] |= explanations[Xj]
+                assignment[Xi] = new_domain
+
+                #If the variable has no possible value, we return a failure
+                if new_domain == 0:
+                    return False
 
-            #But if there is no possible value of j for which (i, j) has a constraint, we remove it. And we continue for the next value of i
-            if revised:
-                assignment[i].remove(legal_i)
+                #If it still has possible values, then we add all its neighbors to the queue, unless they are already in it.
+                #Xj is added too, as the constraint from Xj to Xi doesn't have to be the converse of this one
+                for next_arc in arcs_to[Xi]:
+                    if not in_queue[next_arc]:
+                        in_queue[next_arc] = 1
+                        queue.append(next_arc)
+                dirty.update(alldiffs_of[Xi])
 
-        return revised
+        return True
 
 
 def create_map_coloring_csp():
@@ -233,28 +932,34 @@ def create_map_coloring_csp():
         csp.add_variable(state, colors)
     for state, other_states in edges.items():
         for other_state in other_states:
-            csp.add_constraint_one_way(state, other_state, lambda i, j: i != j)
-            csp.add_constraint_one_way(other_state, state, lambda i, j: i != j)
+            csp.add_constraint_one_way(state, other_state, operator.ne)
+            csp.add_constraint_one_way(other_state, state, operator.ne)
     return csp
 
-def create_sudoku_csp(filename):
-    """Instantiate a CSP representing the Sudoku board found in the text
-    file named 'filename' in the current directory.
+# The CSP of an empty Sudoku board, built by create_sudoku_skeleton()
+sudoku_skeleton = None
+
+def create_sudoku_skeleton():
+    """Instantiate a CSP representing an empty Sudoku board, i.e. with
+    all the values possible for every cell and all the constraints of
+    the rows, columns and boxes. These constraints are the same for
+    every board, so the CSP is only built once and shared afterwards.
     """
-    csp = CSP()
-    board = map(lambda x: x.strip(), open(filename, 'r'))
+    global sudoku_skeleton
+    if sudoku_skeleton is not None:
+        return sudoku_skeleton
 
+    csp = CSP()
     for row in range(9):
         for col in range(9):
-            if board[row][col] == '0':
-                csp.add_variable('%d-%d' % (row, col), map(str, range(1, 10)))
-            else:
-                csp.add_variable('%d-%d' % (row, col), [ board[row][col] ])
+            csp.add_variable('%d-%d' % (row, col), list(range(1, 10)))
 
     for row in range(9):
         csp.add_all_different_constraint([ '%d-%d' % (row, col) for col in range(9) ])
+        csp.add_alldiff([ '%d-%d' % (row, col) for col in range(9) ])
     for col in range(9):
         csp.add_all_different_constraint([ '%d-%d' % (row, col) for row in range(9) ])
+        csp.add_alldiff([ '%d-%d' % (row, col) for row in range(9) ])
     for box_row in range(3):
         for box_col in range(3):
             cells = []
@@ -262,6 +967,25 @@ def create_sudoku_csp(filename):
                 for col in range(box_col * 3, (box_col + 1) * 3):
                     cells.append('%d-%d' % (row, col))
             csp.add_all_different_constraint(cells)
+            csp.add_alldiff(cells)
+
+    sudoku_skeleton = csp
+    return csp
+
+def create_sudoku_csp(filename):
+    """Instantiate a CSP representing the Sudoku board found in the text
+    file named 'filename' in the current directory. This is a copy of
+    the empty board of create_sudoku_skeleton(), where only the domains
+    of the filled cells are changed.
+    """
+    csp = create_sudoku_skeleton().copy()
+    with open(filename, 'r') as board_file:
+        board = [ line.strip() for line in board_file ]
+
+    for row in range(9):
+        for col in range(9):
+            if board[row][col] != '0':
+                csp.domains['%d-%d' % (row, col)] = [ int(board[row][col]) ]
 
     return csp
 
@@ -271,38 +995,45 @@ def print_sudoku_solution(solution):
     representation.
     """
     for row in range(9):
+        line = []
         for col in range(9):
-            print solution['%d-%d' % (row, col)][0],
+            line.append(str(solution['%d-%d' % (row, col)][0]))
             if col == 2 or col == 5:
-                print '|',
-        print
+                line.append('|')
+        print(' '.join(line))
         if row == 2 or row == 5:
-            print '------+-------+------'
+            print('------+-------+------')
 
 
 ### MAIN ###
 
-#We first try to solve the map coloration problem, to see if everything is OK. 
-print 'Solution for the map coloration problem\n'
-m = create_map_coloring_csp()
-print "%s\n\n" % m.backtracking_search() 
-#We now print the stats 
-print 'Backtrack function was called %d time(s)' % m.number_calls
-print 'Backtrack function returned failure %d time(s)\n\n' % m.number_failures
+if __name__ == '__main__':
+    #We first try to solve the map coloration problem, to see if everything is OK. 
+    print('Solution for the map coloration problem\n')
+    m = create_map_coloring_csp()
+    print("%s\n\n" % m.backtracking_search())
+    #We now print the stats 
+    print('Backtrack function was called %d time(s)' % m.number_calls)
+    print('Backtrack function returned failure %d time(s)\n\n' % m.number_failures)
+
+    #The parallel search should find a solution too, and add up the same failures as the sequential one
+    p = create_map_coloring_csp()
+    assert p.backtracking_search_parallel(depth_limit=3) != False
+    assert p.number_failures == m.number_failures, 'Parallel search returned failure %d time(s)' % p.number_failures
 
-#All the sudoku problems
-sudoku_names = ['easy', 'medium', 'hard', 'veryhard']
+    #All the sudoku problems
+    sudoku_names = ['easy', 'medium', 'hard', 'veryhard']
 
-#We loop on all problems
-for name in sudoku_names:
-    print 'Solution for: sudoku %s\n' % name
+    #We loop on all problems
+    for name in sudoku_names:
+        print('Solution for: sudoku %s\n' % name)
 
-    #We create the CSP problem
-    s = create_sudoku_csp('%s.txt' % name)
+        #We create the CSP problem
+        s = create_sudoku_csp('%s.txt' % name)
 
-    #We search the solution and print it
-    print_sudoku_solution(s.backtracking_search())
+        #We search the solution and print it
+        print_sudoku_solution(s.backtracking_search())
 
-    #We now print the stats 
-    print '\nBacktrack function was called %d time(s)' % s.number_calls
-    print 'Backtrack function returned failure %d time(s)\n\n' % s.number_failures
\ No newline at end of file
+        #We now print the stats 
+        print('\nBacktrack function was called %d time(s)' % s.number_calls)
+        print('Backtrack function returned failure %d time(s)\n\n' % s.number_failures)
\ No newline at end of file